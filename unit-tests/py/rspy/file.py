@@ -91,7 +91,12 @@ def _grep( pattern, lines, context ):
         del context['match']
 
 def grep( expr, *args ):
-    pattern = re.compile( expr )
+    """
+    Yield the lines in the given files that match the expression, one at a time, as they're read
+    Each is yielded as the same context dict, updated with 'filename', 'index', 'line', and 'match'
+    :param expr: a regular expression, either as a string or already compiled
+    """
+    pattern = re.compile( expr )  # returns expr as-is if already compiled
     context = dict()
     for filename in args:
         context['filename'] = filename
@@ -14,8 +14,10 @@
 # process and so individual tests cannot affect others except through hardware.
 #
 
-import sys, os, subprocess, locale, re, getopt
+import sys, os, subprocess, locale, re, getopt, threading
 from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 current_dir = os.path.dirname( os.path.abspath( __file__ ) )
 sys.path.append( current_dir + os.sep + "py" )
@@ -78,6 +80,8 @@ for opt, arg in opts:
 
 if len( args ) != 2:
     usage()
+_test_name_re = re.compile( regex ) if regex else None
+list_only = list_tags or list_tests
 dir=args[0]
 builddir=args[1]
 if not os.path.isdir( dir ) or not os.path.isdir( builddir ):
@@ -86,6 +90,20 @@ if not os.path.isdir( dir ) or not os.path.isdir( builddir ):
 # We have to stick to Unix conventions because CMake on Windows is fubar...
 root = repo.root.replace( '\\' , '/' )
 src = root + '/src'
+# Files common to all tests, so we don't build their paths for each
+_test_cpp = root + '/unit-tests/test.cpp'
+_default_main_cpp = root + '/unit-tests/unit-test-default-main.cpp'
+
+# Compiled once, rather than on each (recursive) grep
+_INCLUDE_RE = re.compile( r'^\s*#\s*include\s+("(.*)"|<(.*)>)\s*$' )
+# Must be at the very start of the line; no regex needed to find it
+_CMAKE_DIRECTIVE = '//#cmake:'
+
+# Where to look for includes not relative to the including file (normalized, in Unix form)
+_standard_include_dirs = tuple( os.path.normpath( d ).replace( '\\', '/' ) for d in (
+    root + '/third-party/rsutils/include',
+    root ))
+_realsense2_include_dirs = ( os.path.normpath( root + '/include' ).replace( '\\', '/' ), ) + _standard_include_dirs
 
 
 def add_slash_before_spaces(links):
@@ -103,45 +121,103 @@ def add_slash_before_spaces(links):
         raise TypeError
 
 
-def generate_cmake( builddir, testdir, testname, filelist, custom_main, dependencies ):
-    makefile = builddir + '/' + testdir + '/CMakeLists.txt'
-    log.d( '   creating:', makefile )
-    handle = open( makefile, 'w' )
+def write_if_changed( filename, content ):
+    """
+    Write the content to the file, but only if it's different than what's already there
+    Rewriting an unchanged CMakeLists.txt would needlessly make CMake reconfigure it
 
-    #filelist = add_slash_before_spaces(filelist)
-    directory = add_slash_before_spaces(dir)
-    root_directory = add_slash_before_spaces(root)
+    The new content is written to a temporary file that then replaces the original, so a
+    CMakeLists.txt is never left half-written
 
-    filelist = '\n    '.join( filelist )
-    handle.write( '''
+    :return: True if the file was written
+    """
+    try:
+        with open( filename, errors = 'ignore' ) as handle:
+            if handle.read() == content:
+                log.d( '   unchanged:', filename )
+                return False
+    except FileNotFoundError:
+        pass
+    log.d( '   creating:', filename )
+    tempname = filename + '.tmp'
+    with open( tempname, 'w' ) as handle:
+        handle.write( content )
+    os.replace( tempname, filename )
+    return True
+
+
+# The per-test CMakeLists.txt; note CMake's ${...} braces are doubled for str.format()
+_CMAKE_TEMPLATE = '''
 # This file is automatically generated!!
 # Do not modify or your changes will be lost!
 
 cmake_minimum_required( VERSION 3.10.0 )
-project( ''' + testname + ''' )
+project( {testname} )
 
-set( SRC_FILES ''' + filelist + '''
+set( SRC_FILES {filelist}
 )
-add_executable( ${PROJECT_NAME} ${SRC_FILES} )
-add_definitions( ''' + ' '.join( f'-DLIBCI_DEPENDENCY_{d}' for d in dependencies.split() ) + ''' )
-source_group( "Common Files" FILES ''' + directory + '''/test.cpp''')
-    if not custom_main:
-        handle.write(' ' + directory + '/unit-test-default-main.cpp')
-    handle.write( ''' )
-target_link_libraries( ${PROJECT_NAME} ''' + dependencies + ''' Catch2 )
+add_executable( ${{PROJECT_NAME}} ${{SRC_FILES}} )
+add_definitions( {definitions} )
+source_group( "Common Files" FILES {directory}/test.cpp{main} )
+target_link_libraries( ${{PROJECT_NAME}} {dependencies} Catch2 )
 
-set_target_properties( ${PROJECT_NAME} PROPERTIES FOLDER "Unit-Tests/''' + os.path.dirname( testdir ) + '''" )
+set_target_properties( ${{PROJECT_NAME}} PROPERTIES FOLDER "Unit-Tests/{folder}" )
 
-using_easyloggingpp( ${PROJECT_NAME} SHARED )
+using_easyloggingpp( ${{PROJECT_NAME}} SHARED )
 
 # Add the repo root directory (so includes into src/ will be specific: <src/...>)
-target_include_directories( ${PROJECT_NAME} PRIVATE ''' + root + ''')
+target_include_directories( ${{PROJECT_NAME}} PRIVATE {root})
+
+'''
+
 
-''' )
+class TestInfo:
+    """
+    Everything we need to know about a test .cpp in order to generate its CMakeLists.txt
+    """
+    __slots__ = ( 'f', 'path', 'testdir', 'testparent', 'testname', 'filelist', 'shared', 'static', 'custom_main', 'dependencies' )
 
-    handle.close()
+    def __init__( self, dir, f ):
+        self.f = f
+        self.testdir = os.path.splitext( f )[0]                     # "log/internal/test-all"  <-  "log/internal/test-all.cpp"
+        self.testparent = os.path.dirname( self.testdir )           # "log/internal"
+        # We need the project name unique: keep the path but make it nicer:
+        if self.testparent:
+            self.testname = 'test-' + self.testparent.replace( '/', '-' ) + '-' + os.path.basename( self.testdir )[
+                                                                                5:]  # "test-log-internal-all"
+        else:
+            self.testname = self.testdir  # no parent folder so we get "test-all"
+        self.path = dir + '/' + f                                   # "<dir>/log/internal/test-all.cpp"
+        self.filelist = [ self.path ]
+        self.shared = False
+        self.static = False
+        self.custom_main = False
+        self.dependencies = 'realsense2'
 
 
+def generate_cmake( test ):
+    """
+    :return: the content of the CMakeLists.txt for the given TestInfo
+    """
+    #filelist = add_slash_before_spaces(filelist)
+    directory = add_slash_before_spaces(dir)
+    root_directory = add_slash_before_spaces(root)
+
+    main = ''
+    if not test.custom_main:
+        main = ' ' + directory + '/unit-test-default-main.cpp'
+    return _CMAKE_TEMPLATE.format(
+        testname = test.testname,
+        filelist = '\n    '.join( test.filelist ),
+        definitions = ' '.join( f'-DLIBCI_DEPENDENCY_{d}' for d in test.dependencies.split() ),
+        directory = directory,
+        main = main,
+        dependencies = test.dependencies,
+        folder = test.testparent,
+        root = root )
+
+
+@lru_cache( maxsize=None )  # the filesystem does not change while we run
 def find_include( include, relative_to ):
     """
     Try to match the include to an existing file.
@@ -158,9 +234,11 @@ def find_include( include, relative_to ):
             return include
 
 
+@lru_cache( maxsize=None )
 def find_include_in_dirs( include, dirs ):
     """
     Search for the given include in all the specified directories
+    :param dirs: a tuple (must be hashable) of directories
     """
     for include_dir in dirs:
         path = find_include( include, include_dir )
@@ -168,173 +246,284 @@ def find_include_in_dirs( include, dirs ):
             return path
 
 
-def find_includes( filepath, filelist, dependencies ):
+# Resolved direct includes of each file we've scanned, keyed by (filepath, include_dirs)
+_direct_includes_cache = dict()
+# #include matches of test .cpp files, already found by scan_cpp()
+_include_matches_cache = dict()
+
+
+def scan_cpp( filepath ):
     """
-    Recursively searches a .cpp file for #include directives
-    :param filelist: any previous includes already processed (pass an empty dict() if none)
-    :param dependencies: set of dependencies
-    :return: a dictionary (include->source) of includes found
+    Reads a test .cpp once, collecting both its #include and //#cmake: directives
+    The include matches are kept for find_direct_includes(), so the file is not read again
+    :return: a list of (index, directive) for each //#cmake: line, with the prefix removed
     """
-    include_dirs = list()
-    if 'realsense2' in dependencies:
-        include_dirs.append( os.path.join( root, 'include' ))
-    include_dirs.append( os.path.join( root, 'third-party', 'rsutils', 'include' ))
-    include_dirs.append( root )
-    
+    include_matches = []
+    directives = []
+    with open( filepath, errors = 'ignore' ) as handle:
+        for index, line in enumerate( file.remove_newlines( handle ), 1 ):
+            if line.startswith( _CMAKE_DIRECTIVE ):
+                directives.append( ( index, line[len( _CMAKE_DIRECTIVE ):] ))
+                continue
+            m = _INCLUDE_RE.search( line )
+            if m:
+                include_matches.append( m )
+    _include_matches_cache[filepath] = include_matches
+    return directives
+
+
+def find_direct_includes( filepath, include_dirs ):
+    """
+    Searches a file for #include directives and resolves them to existing files
+    Each file is scanned only once: the results are cached for any further calls
+    :param include_dirs: tuple of directories to search for non-relative includes
+    :return: a tuple of resolved includes, in the order they appear in the file
+    """
+    key = ( filepath, include_dirs )
+    includes = _direct_includes_cache.get( key )
+    if includes is not None:
+        return includes
+
+    includes = []
     filedir = os.path.dirname(filepath)
+    log.d( 'scanning:', filepath )
     try:
         log.debug_indent()
-        for include_line in file.grep( r'^\s*#\s*include\s+("(.*)"|<(.*)>)\s*$', filepath ):
-            m = include_line['match']
-            index = include_line['index']
+        include_matches = _include_matches_cache.get( filepath )
+        if include_matches is None:
+            include_matches = ( include_line['match'] for include_line in file.grep( _INCLUDE_RE, filepath ))
+        for m in include_matches:
             include = find_include( m.group(2), filedir ) or find_include_in_dirs( m.group(2), include_dirs ) or find_include_in_dirs( m.group(3), include_dirs )
             if include:
-                if include in filelist:
-                    log.d( m.group(0), '->', include, '(already processed)' )
-                else:
-                    log.d( m.group(0), '->', include )
-                    filelist[include] = filepath
-                    filelist = find_includes( include, filelist, dependencies )
+                log.d( m.group(0), '->', include )
+                includes.append( include )
             else:
                 log.d( 'not found:', m.group(0) )
     finally:
         log.debug_unindent()
-    return filelist
+    includes = tuple( includes )
+    _direct_includes_cache[key] = includes
+    return includes
 
-def process_cpp( dir, builddir ):
-    global regex, required_tags, list_only, available_tags, tests_and_tags, live_only, not_live_only
-    found = []
-    shareds = []
-    statics = []
-    if regex:
-        pattern = re.compile( regex )
-    log.d( 'looking for C++ files in:', dir )
-    for f in file.find( dir, '(^|/)test-.*\.cpp$' ):
-        testdir = os.path.splitext( f )[0]                          # "log/internal/test-all"  <-  "log/internal/test-all.cpp"
-        testparent = os.path.dirname(testdir)                       # "log/internal"
-        # We need the project name unique: keep the path but make it nicer:
-        if testparent:
-            testname = 'test-' + testparent.replace( '/', '-' ) + '-' + os.path.basename( testdir )[
-                                                                        5:]  # "test-log-internal-all"
-        else:
-            testname = testdir  # no parent folder so we get "test-all"
 
-        if regex and not pattern.search( testname ):
+def find_includes( filepath, dependencies ):
+    """
+    Searches a .cpp file for #include directives, and then the includes themselves, etc.
+    :param dependencies: set of dependencies
+    :return: a new dictionary (include->source) of includes found
+    """
+    if 'realsense2' in dependencies:
+        include_dirs = _realsense2_include_dirs
+    else:
+        include_dirs = _standard_include_dirs
+
+    # Walk the include graph depth-first, in the order the includes appear (same order
+    # a recursive scan would produce); the stack holds (include, source) pairs
+    filelist = dict()
+    stack = [( include, filepath ) for include in reversed( find_direct_includes( filepath, include_dirs ))]
+    while stack:
+        include, source = stack.pop()
+        if include in filelist:
             continue
+        filelist[include] = source
+        stack.extend( ( sub, include ) for sub in reversed( find_direct_includes( include, include_dirs )))
+    return filelist
 
-        log.d( '... found:', f )
-        log.debug_indent()
+def make_dirs( builddir, subdirs ):
+    """
+    Create all the given directories under builddir, including their parents
+    Tests share most of their parents, so each is only created once, parents first
+    """
+    needed = set()
+    for subdir in subdirs:
+        while subdir and subdir not in needed:
+            needed.add( subdir )
+            subdir = os.path.dirname( subdir )
+    for subdir in sorted( needed ):
+        try:
+            os.mkdir( builddir + '/' + subdir )
+        except FileExistsError:
+            pass
+
+
+def find_cpp_tests( dir, subdir = '' ):
+    """
+    Yield all test-*.cpp files in dir (including sub-directories), relative to dir
+    Same order as file.find(), but a name check is cheaper than a regex search on each path
+
+    :param subdir: the sub-directory (with a trailing '/') to look in, for recursion
+    """
+    try:
+        entries = list( os.scandir( dir + '/' + subdir ))
+    except OSError:
+        return
+    subdirs = []
+    for entry in entries:
         try:
-            config = libci.TestConfigFromCpp( dir + os.sep + f, context )
-            if required_tags or list_tags:
-                if not all( tag in config.tags for tag in required_tags ):
-                    continue
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            if not entry.is_symlink():
+                subdirs.append( subdir + entry.name + '/' )
+        elif entry.name.startswith( 'test-' ) and entry.name.endswith( '.cpp' ):
+            yield subdir + entry.name
+    for sub in subdirs:
+        yield from find_cpp_tests( dir, sub )
+
+
+# Guards the state shared between the threads running process_cpp_test()
+_lock = threading.Lock()
+
+
+def process_cpp_test( dir, builddir, f ):
+    """
+    Figure out what a single test .cpp needs in its CMakeLists.txt
+    This is run from several threads at once: global state must only be changed under _lock!
+
+    :param f: the test .cpp, relative to dir
+    :return: a TestInfo, or None if the test is not to be configured
+    """
+    global required_tags, list_only, available_tags, tests_and_tags, live_only, not_live_only
+    test = TestInfo( dir, f )
+
+    if _test_name_re and not _test_name_re.search( test.testname ):
+        return None
+
+    log.d( '... found:', f )
+    log.debug_indent()
+    try:
+        config = libci.TestConfigFromCpp( dir + os.sep + f, context )
+        if required_tags or list_tags:
+            if not all( tag in config.tags for tag in required_tags ):
+                return None
+            with _lock:
                 available_tags.update( config.tags )
                 if list_tests:
-                    tests_and_tags[ testname ] = config.tags
+                    tests_and_tags[ test.testname ] = config.tags
 
-            if testname not in tests_and_tags:
-                tests_and_tags[testname] = None
+        with _lock:
+            if test.testname not in tests_and_tags:
+                tests_and_tags[test.testname] = None
 
-            if live_only:
-                if not config.configurations:
-                    continue
-            elif not_live_only:
-                if config.configurations:
-                    continue
+        # Listing only needs the test names and tags: no need to go through its files
+        if list_only:
+            return None
 
-            if config.donotrun:
-                continue
-
-            # Build the list of files we want in the project:
-            # At a minimum, we have the original file, plus any common files
-            filelist = [ dir + '/' + f ]
-            includes = dict()
-            # Add any files explicitly listed in the .cpp itself, like this:
-            #         //#cmake:add-file <filename>
-            # Any files listed are relative to $dir
-            shared = False
-            static = False
-            custom_main = False
-            dependencies = 'realsense2'
-            for cmake_directive in file.grep( '^//#cmake:\s*', dir + '/' + f ):
-                m = cmake_directive['match']
-                index = cmake_directive['index']
-                cmd, *rest = cmake_directive['line'][m.end():].split()
-                if cmd == 'add-file':
-                    for additional_file in rest:
-                        files = additional_file
-                        if not os.path.isabs( additional_file ):
-                            files = dir + '/' + testparent + '/' + additional_file
-                        files = glob( files )
-                        if not files:
-                            log.e( f + '+' + str(index) + ': no files match "' + additional_file + '"' )
-                        for abs_file in files:
-                            abs_file = os.path.normpath( abs_file )
-                            abs_file = abs_file.replace( '\\', '/' )
-                            if not os.path.exists( abs_file ):
-                                log.e( f + '+' + str(index) + ': file not found "' + additional_file + '"' )
-                            log.d( 'add file:', abs_file )
-                            filelist.append( abs_file )
-                            if( os.path.splitext( abs_file )[0] == 'cpp' ):
-                                # Add any "" includes specified in the .cpp that we can find
-                                includes = find_includes( abs_file, includes, dependencies )
-                elif cmd == 'static!':
-                    if len(rest):
-                        log.e( f + '+' + str(index) + ': unexpected arguments past \'' + cmd + '\'' )
-                    elif shared:
-                        log.e( f + '+' + str(index) + ': \'' + cmd + '\' mutually exclusive with \'shared!\'' )
-                    else:
-                        log.d( 'static!' )
-                        static = True
-                elif cmd == 'shared!':
-                    if len(rest):
-                        log.e( f + '+' + str(index) + ': unexpected arguments past \'' + cmd + '\'' )
-                    elif static:
-                        log.e( f + '+' + str(index) + ': \'' + cmd + '\' mutually exclusive with \'static!\'' )
+        if live_only:
+            if not config.configurations:
+                return None
+        elif not_live_only:
+            if config.configurations:
+                return None
+
+        if config.donotrun:
+            return None
+
+        # Build the list of files we want in the project:
+        # At a minimum, we have the original file (already in test.filelist), plus any common files
+        includes = dict()
+        # Add any files explicitly listed in the .cpp itself, like this:
+        #         //#cmake:add-file <filename>
+        # Any files listed are relative to $dir
+        for index, cmake_directive in scan_cpp( test.path ):
+            cmd, *rest = cmake_directive.split()
+            if cmd == 'add-file':
+                for additional_file in rest:
+                    candidate = additional_file
+                    if not os.path.isabs( additional_file ):
+                        candidate = dir + '/' + test.testparent + '/' + additional_file
+                    # Only wildcards need glob(), which lists the whole directory
+                    if any( c in additional_file for c in '*?[' ):
+                        files = glob( candidate )
+                    elif os.path.exists( candidate ):
+                        files = [candidate]
                     else:
-                        log.d( 'shared!' )
-                        shared = True
-                elif cmd == 'custom-main':
-                    custom_main = True
-                elif cmd == 'dependencies':
-                    dependencies = ' '.join( rest )
+                        files = []
+                    if not files:
+                        log.e( f + '+' + str(index) + ': no files match "' + additional_file + '"' )
+                    for abs_file in files:
+                        abs_file = os.path.normpath( abs_file )
+                        abs_file = abs_file.replace( '\\', '/' )
+                        if not os.path.exists( abs_file ):
+                            log.e( f + '+' + str(index) + ': file not found "' + additional_file + '"' )
+                        log.d( 'add file:', abs_file )
+                        test.filelist.append( abs_file )
+                        if os.path.splitext( abs_file )[1] == '.cpp':
+                            # Add any "" includes specified in the .cpp that we can find
+                            for include, source in find_includes( abs_file, test.dependencies ).items():
+                                includes.setdefault( include, source )
+            elif cmd == 'static!':
+                if len(rest):
+                    log.e( f + '+' + str(index) + ': unexpected arguments past \'' + cmd + '\'' )
+                elif test.shared:
+                    log.e( f + '+' + str(index) + ': \'' + cmd + '\' mutually exclusive with \'shared!\'' )
+                else:
+                    log.d( 'static!' )
+                    test.static = True
+            elif cmd == 'shared!':
+                if len(rest):
+                    log.e( f + '+' + str(index) + ': unexpected arguments past \'' + cmd + '\'' )
+                elif test.static:
+                    log.e( f + '+' + str(index) + ': \'' + cmd + '\' mutually exclusive with \'static!\'' )
                 else:
-                    log.e( f + '+' + str(index) + ': unknown cmd \'' + cmd + '\' (should be \'add-file\', \'static!\', or \'shared!\')' )
+                    log.d( 'shared!' )
+                    test.shared = True
+            elif cmd == 'custom-main':
+                test.custom_main = True
+            elif cmd == 'dependencies':
+                test.dependencies = ' '.join( rest )
+            else:
+                log.e( f + '+' + str(index) + ': unknown cmd \'' + cmd + '\' (should be \'add-file\', \'static!\', or \'shared!\')' )
 
-            # Add any includes specified in the .cpp that we can find
-            includes = find_includes( dir + '/' + f, includes, dependencies )
-            for include,source in includes.items():
-                filelist.append( f'"{include}"  # {source}' )
+        # Add any includes specified in the .cpp that we can find
+        for include, source in find_includes( test.path, test.dependencies ).items():
+            includes.setdefault( include, source )
+        for include,source in includes.items():
+            test.filelist.append( f'"{include}"  # {source}' )
 
-            # all tests use the common test.cpp file
-            filelist.append( root + "/unit-tests/test.cpp" )
+        # all tests use the common test.cpp file
+        test.filelist.append( _test_cpp )
 
-            # 'cmake:custom-main' indicates that the test is defining its own main() function.
-            # If not specified we use a default main() which lives in its own .cpp:
-            if not custom_main:
-                filelist.append( root + "/unit-tests/unit-test-default-main.cpp" )
+        # 'cmake:custom-main' indicates that the test is defining its own main() function.
+        # If not specified we use a default main() which lives in its own .cpp:
+        if not test.custom_main:
+            test.filelist.append( _default_main_cpp )
 
-            if list_only:
-                continue
+        return test
+    finally:
+        log.debug_unindent()
 
-            # Each CMakeLists.txt sits in its own directory
-            os.makedirs( builddir + '/' + testdir, exist_ok=True )  # "build/log/internal/test-all"
-            generate_cmake( builddir, testdir, testname, filelist, custom_main, dependencies )
-            if static:
-                statics.append( testdir )
-            elif shared:
-                shareds.append( testdir )
-            else:
-                found.append( testdir )
-        finally:
-            log.debug_unindent()
+
+def process_cpp( dir, builddir ):
+    found = []
+    shareds = []
+    statics = []
+    log.d( 'looking for C++ files in:', dir )
+    tests = list( find_cpp_tests( dir ))
+    # Tests are independent of each other, and most of the work is waiting on file I/O, so
+    # handle them in parallel -- but debug output is indented per test, so not when debugging
+    max_workers = 1 if log.is_debug_on() else os.cpu_count()
+    with ThreadPoolExecutor( max_workers = max_workers ) as executor:
+        results = [test for test in executor.map( lambda f: process_cpp_test( dir, builddir, f ), tests )
+                   if test is not None]
+        # Generate everything in memory, then write only the files whose content changed
+        # Each CMakeLists.txt sits in its own directory, e.g. "build/log/internal/test-all"
+        makefiles = [( builddir + '/' + test.testdir + '/CMakeLists.txt', generate_cmake( test )) for test in results]
+        make_dirs( builddir, [test.testdir for test in results] )
+        list( executor.map( lambda makefile: write_if_changed( *makefile ), makefiles ))
+    for test in results:
+        if test.static:
+            statics.append( test.testdir )
+        elif test.shared:
+            shareds.append( test.testdir )
+        else:
+            found.append( test.testdir )
     return found, shareds, statics
 def process_py( dir, builddir ):
     # TODO
     return [],[],[]
 
-list_only = list_tags or list_tests
 available_tags = set()
 tests_and_tags = dict()
 normal_tests = []
@@ -368,35 +557,24 @@ cmakefile = builddir + '/CMakeLists.txt'
 name = os.path.basename( os.path.realpath( dir ))
 log.d( 'Creating "' + name + '" project in', cmakefile )
 
-handle = open( cmakefile, 'w' )
-handle.write( '''
-
-''' )
-
-n_tests = 0
-for sdir in normal_tests:
-    handle.write( 'add_subdirectory( ' + sdir + ' )\n' )
-    log.d( '... including:', sdir )
-    n_tests += 1
+chunks = [ '\n\n' ]
+chunks += [ 'add_subdirectory( ' + sdir + ' )\n' for sdir in normal_tests ]
 if len(shared_tests):
-    handle.write( 'if(NOT ${BUILD_SHARED_LIBS})\n' )
-    handle.write( '    message( INFO " ' + str(len(shared_tests)) + ' shared lib unit-tests will be skipped. Check BUILD_SHARED_LIBS to run them..." )\n' )
-    handle.write( 'else()\n' )
-    for test in shared_tests:
-        handle.write( '    add_subdirectory( ' + test + ' )\n' )
-        log.d( '... including:', sdir )
-        n_tests += 1
-    handle.write( 'endif()\n' )
+    chunks.append( 'if(NOT ${BUILD_SHARED_LIBS})\n' )
+    chunks.append( '    message( INFO " ' + str(len(shared_tests)) + ' shared lib unit-tests will be skipped. Check BUILD_SHARED_LIBS to run them..." )\n' )
+    chunks.append( 'else()\n' )
+    chunks += [ '    add_subdirectory( ' + test + ' )\n' for test in shared_tests ]
+    chunks.append( 'endif()\n' )
 if len(static_tests):
-    handle.write( 'if(${BUILD_SHARED_LIBS})\n' )
-    handle.write( '    message( INFO " ' + str(len(static_tests)) + ' static lib unit-tests will be skipped. Uncheck BUILD_SHARED_LIBS to run them..." )\n' )
-    handle.write( 'else()\n' )
-    for test in static_tests:
-        handle.write( '    add_subdirectory( ' + test + ' )\n' )
-        log.d( '... including:', sdir )
-        n_tests += 1
-    handle.write( 'endif()\n' )
-handle.close()
+    chunks.append( 'if(${BUILD_SHARED_LIBS})\n' )
+    chunks.append( '    message( INFO " ' + str(len(static_tests)) + ' static lib unit-tests will be skipped. Uncheck BUILD_SHARED_LIBS to run them..." )\n' )
+    chunks.append( 'else()\n' )
+    chunks += [ '    add_subdirectory( ' + test + ' )\n' for test in static_tests ]
+    chunks.append( 'endif()\n' )
+for sdir in normal_tests + shared_tests + static_tests:
+    log.d( '... including:', sdir )
+n_tests = len(normal_tests) + len(shared_tests) + len(static_tests)
+write_if_changed( cmakefile, ''.join( chunks ))
 
 print( 'Generated ' + str(n_tests) + ' unit-tests' )
 if log.n_errors():